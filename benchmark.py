@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+'''
+dbinventory benchmark
+=====================
+
+Generates an inventory of the given size and times dbinventory.py against it:
+--list, --host and --ssh-config through the read-only fast path and with it
+disabled (DBINVENTORY_FASTPATH=0), --db-import into a new database,
+--db-export, the queries the -e editor runs to refresh its lists, and a --batch
+registering new hosts.
+
+    ./benchmark.py --hosts 2000 --tags-per-host 5 --secrets 0.5 --json results.json
+
+Reports the median wall time, the peak RSS and the number of SQL statements of
+each operation, as a table and, with --json, as JSON. Statements are counted in
+one extra run, so counting does not slow down the timed ones. Equal arguments
+and --seed generate equal inventories; --generate only writes the inventory.
+
+With --stress, reader processes call --list (half of them through the full
+script) while a writer process keeps re-importing the whole inventory, once
+per journal mode. Reports failed calls and latencies of both, and exits with 1
+when a call failed or hit "database is locked", a reader listed fewer hosts,
+or the database left behind lost hosts, tags, groups or host tags.
+
+    ./benchmark.py --stress --hosts 2000 --readers 8 --seconds 20
+'''
+
+import os
+import sys
+import imp
+import json
+import random
+import shutil
+import atexit
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from time import time
+from collections import OrderedDict
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dbinventory.py')
+
+# the editor search timed by ui-search, matching host01000 to host01999
+UI_SEARCH_TEXT = 'st01'
+UI_PAGE_SIZE = 50
+
+# new hosts registered by every --batch call
+BATCH_HOSTS = 500
+
+
+def generate_inventory(hosts, tags=20, groups=4, tags_per_host=3, secrets=0.0, seed=0):
+    ''' A synthetic inventory, as read by --db-import. A fraction of secrets hosts
+        get passwords, which are stored encrypted with the --db-secret. '''
+    rand = random.Random(seed)
+    data = {"groups": [], "tags": [], "hosts": []}
+
+    for i in range(groups):
+        data['groups'].append({"name": "group%d" % i, "type": "multiselect"})
+
+    for i in range(tags):
+        data['tags'].append({"name": "tag%d" % i, "group": "group%d" % (i % groups)})
+
+    for i in range(hosts):
+        host = {
+            "host": "host%05d" % i,
+            "host_name": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "ssh_user": "deploy",
+            "tags": ["tag%d" % t for t in rand.sample(range(tags), min(tags_per_host, tags))]
+        }
+        if secrets and rand.random() < secrets:
+            host['ssh_pass'] = "ssh%05d" % i
+            host['sudo_pass'] = "sudo%05d" % i
+        data['hosts'].append(host)
+
+    return data
+
+
+def run(args, env):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, SCRIPT] + args, stdout=devnull, env=env)
+
+
+def call(command, env):
+    ''' Runs command, returns its (seconds, peak RSS in kB, stdout) '''
+    start = time()
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(command, stdout=output, env=env)
+        # wait4 reports the resources of this child only
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status)
+        seconds = time() - start
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+        output.seek(0)
+        return seconds, usage.ru_maxrss, output.read()
+
+
+def measure(name, mode, args, env, runs, setup=None):
+    ''' Times runs calls of dbinventory.py with args, calling setup before each,
+        and counts the SQL statements of one more call '''
+    timings = []
+    peak_rss = 0
+    for i in range(runs):
+        if setup:
+            setup()
+        seconds, rss, output = call([sys.executable, SCRIPT] + args, env)
+        timings.append(seconds)
+        peak_rss = max(peak_rss, rss)
+
+    if setup:
+        setup()
+    stats = tempfile.NamedTemporaryFile(suffix='.json')
+    call([sys.executable, os.path.abspath(__file__), '--count-sql', stats.name, '--'] + args, env)
+    statements = json.load(stats)['statements']
+
+    return result(name, mode, runs, timings, peak_rss, statements)
+
+
+def measure_ui(name, db_path, env, runs, text=''):
+    ''' Times the list refresh of the editor, in a process of its own '''
+    timings = []
+    peak_rss = 0
+    for i in range(runs):
+        seconds, rss, output = call([sys.executable, os.path.abspath(__file__), '--ui-refresh', db_path, text], env)
+        refresh = json.loads(output)
+        timings.append(refresh['seconds'])
+        peak_rss = max(peak_rss, rss)
+
+    return result(name, 'in-process', runs, timings, peak_rss, refresh['statements'])
+
+
+def result(name, mode, runs, timings, peak_rss, statements):
+    return OrderedDict([
+        ('name', name), ('mode', mode), ('runs', runs),
+        ('wall_ms', OrderedDict([('median', percentile(timings, 0.5) * 1000), ('min', min(timings) * 1000), ('max', max(timings) * 1000)])),
+        ('peak_rss_kb', peak_rss), ('sql_statements', statements)])
+
+
+def count_sql(stats_path, args):
+    ''' Runs dbinventory.py with args in this process, writing the number of
+        SQL statements it executes, through sqlalchemy or the fast path's
+        sqlite3 connection, to stats_path on exit '''
+    import sqlite3
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    counts = {"statements": 0}
+
+    def count(*args):
+        counts['statements'] += 1
+
+    class CountingConnection(sqlite3.Connection):
+        def execute(self, *args):
+            count()
+            return sqlite3.Connection.execute(self, *args)
+
+    connect = sqlite3.connect
+    sqlite3.connect = lambda *args, **kwargs: connect(*args, factory=CountingConnection, **kwargs)
+    event.listen(Engine, 'before_cursor_execute', count)
+
+    def write():
+        with open(stats_path, 'w') as stats:
+            json.dump(counts, stats)
+    atexit.register(write)
+
+    sys.argv = [SCRIPT] + args
+    imp.load_source('__main__', SCRIPT)
+
+
+def ui_refresh(db_path, text):
+    ''' Times what the editor does to show its host and tag lists: counting the
+        records matching text, and loading the lines of the first screen.
+        Searches first bring the search index up to date, not timed. Prints
+        the seconds and the statements of the refresh as JSON. '''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    inventory = imp.load_source('dbinventory', SCRIPT)
+    controller = object.__new__(inventory.BlueAcornInventory)
+    controller.__dict__.update(db_path=db_path, db_url='sqlite:///' + db_path, db_engine=None, db_session=None)
+    if len(text) >= 3:
+        controller.database_refresh_search()
+
+    counts = {"statements": 0}
+
+    def count(*args):
+        counts['statements'] += 1
+    event.listen(Engine, 'before_cursor_execute', count)
+
+    db = controller.database_get_session()
+    start = time()
+    for section in ['hosts', 'tags']:
+        values = inventory.PagedQuery(inventory.search_query(db, section, text))
+        values[:UI_PAGE_SIZE]
+
+    print json.dumps({"seconds": time() - start, "statements": counts['statements']})
+
+
+def stress(env, args, readers, writer_args, seconds, hosts):
+    ''' Runs readers processes calling args (--list), and one writer process
+        calling each of writer_args in turn, for seconds. Returns (seconds, error)
+        per call and role, error is None for calls that exited cleanly without
+        a locking error and, for readers, listed all hosts. '''
+    calls = {'reader': [], 'writer': []}
+    deadline = time() + seconds
+
+    def loop(role, env, args_cycle):
+        i = 0
+        while time() < deadline:
+            start = time()
+            process = subprocess.Popen([sys.executable, SCRIPT] + args_cycle[i % len(args_cycle)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            output, errors = process.communicate()
+            seconds = time() - start
+
+            error = None
+            if process.returncode or 'database is locked' in errors:
+                lines = (errors or output).strip().splitlines()
+                lines = [line for line in lines if 'database is locked' in line] or [line for line in lines if not line.startswith('(Background')] or ['']
+                error = 'exit %d: %s' % (process.returncode, lines[-1][:200])
+            elif role == 'reader':
+                try:
+                    listed = len(json.loads(output)['all'])
+                except (ValueError, KeyError), e:
+                    listed = 'invalid output: %s' % (e)
+                if listed != hosts:
+                    error = 'listed %s of %d hosts' % (listed, hosts)
+
+            calls[role].append((seconds, error))
+            i += 1
+
+    slow_env = dict(env, DBINVENTORY_FASTPATH='0')
+    threads = [threading.Thread(target=loop, args=('writer', env, writer_args))]
+    threads += [threading.Thread(target=loop, args=('reader', slow_env if i % 2 else env, [args])) for i in range(readers)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return calls
+
+
+def check_inventory(env, args):
+    ''' Problems of the inventory left by --stress: the writer re-imports the same
+        groups, tags and hosts, only their counts and host tags may not change '''
+    process = subprocess.Popen([sys.executable, SCRIPT, '--db-export'], stdout=subprocess.PIPE, env=dict(env, DBINVENTORY_FASTPATH='0'))
+    output = process.communicate()[0]
+    if process.returncode:
+        return ['--db-export failed with exit %d' % (process.returncode)]
+
+    data = json.loads(output)
+    problems = []
+    for section, expected in [('groups', args.groups), ('tags', args.tags), ('hosts', args.hosts)]:
+        if len(data[section]) != expected:
+            problems.append('%d %s instead of %d' % (len(data[section]), section, expected))
+
+    tags_per_host = min(args.tags_per_host, args.tags)
+    mistagged = [host['host'] for host in data['hosts'] if len(host['tags']) != tags_per_host]
+    if mistagged:
+        problems.append('%d hosts without %d tags, e.g. %s' % (len(mistagged), tags_per_host, mistagged[0]))
+
+    return problems
+
+
+def percentile(timings, fraction):
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def suite(args, workdir, env, db_path, data_path):
+    ''' Runs every measurement, returns their results '''
+    slow_env = dict(env, DBINVENTORY_FASTPATH='0')
+    results = []
+
+    for name, cli_args in [('list', ['--list']), ('host', ['--host', 'host00000']), ('ssh-config', ['--ssh-config'])]:
+        results.append(measure(name, 'fast path', cli_args, env, args.runs))
+        results.append(measure(name, 'full script', cli_args, slow_env, args.runs))
+
+    import_path = os.path.join(workdir, 'import.sqlite3')
+
+    def remove_import():
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(import_path + suffix):
+                os.remove(import_path + suffix)
+
+    results.append(measure('db-import', 'full script', ['--db-path', import_path, '--db-create', '--db-import', data_path], env, args.write_runs, remove_import))
+    results.append(measure('db-export', 'full script', ['--db-export', os.devnull], env, args.write_runs))
+
+    results.append(measure_ui('ui-refresh', db_path, env, args.runs))
+    results.append(measure_ui('ui-search', db_path, env, args.runs, UI_SEARCH_TEXT))
+
+    # last, the measured calls leave the new hosts behind
+    batch_path = os.path.join(workdir, 'batch.jsonl')
+    remove_path = os.path.join(workdir, 'remove.jsonl')
+    with open(batch_path, 'w') as batch_file, open(remove_path, 'w') as remove_file:
+        for i in range(BATCH_HOSTS):
+            batch_file.write(json.dumps({"op": "add-host", "host": "batch%05d" % i, "tags": ["tag%d" % (i % args.tags)]}) + '\n')
+            remove_file.write(json.dumps({"op": "del-host", "host": "batch%05d" % i}) + '\n')
+
+    results.append(measure('batch', 'full script', ['--batch', batch_path], env, args.write_runs, lambda: run(['--batch', remove_path], env)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dbinventory.py against a generated inventory')
+    parser.add_argument('--hosts', type=int, default=500, help='Number of generated hosts')
+    parser.add_argument('--tags', type=int, default=20, help='Number of generated tags')
+    parser.add_argument('--tags-per-host', type=int, default=3, help='Tags of every generated host')
+    parser.add_argument('--groups', type=int, default=4, help='Number of generated tag groups')
+    parser.add_argument('--secrets', type=float, default=0.0, help='Fraction of generated hosts with passwords, 0 to 1. Calls then use a --db-secret')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated inventory')
+    parser.add_argument('--generate', action='store', help='Only write the generated inventory to this file, for --db-import')
+    parser.add_argument('--runs', type=int, default=20, help='Invocations per measurement, the median is reported')
+    parser.add_argument('--write-runs', type=int, default=3, help='Invocations per --db-import and --db-export measurement')
+    parser.add_argument('--json', action='store', help='Also write the results as JSON to this file, - for stdout')
+    parser.add_argument('--stress', action='store_true', help='Run concurrent readers and a writer instead of timing single calls')
+    parser.add_argument('--readers', type=int, default=8, help='Concurrent reader processes of --stress')
+    parser.add_argument('--seconds', type=int, default=20, help='Duration of --stress, per journal mode')
+    args = parser.parse_args()
+
+    inventory = generate_inventory(args.hosts, args.tags, args.groups, args.tags_per_host, args.secrets, args.seed)
+    if args.generate:
+        with open(args.generate, 'w') as data_file:
+            json.dump(inventory, data_file)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='dbinventory-bench-')
+    try:
+        db_path = os.path.join(workdir, 'bench.sqlite3')
+        data_path = os.path.join(workdir, 'bench.json')
+        with open(data_path, 'w') as data_file:
+            json.dump(inventory, data_file)
+
+        env = dict(os.environ)
+        env.pop('DBINVENTORY_SECRET', None)
+        env.pop('DBINVENTORY_URL', None)
+        env['DBINVENTORY_PATH'] = db_path
+        if args.secrets:
+            env['DBINVENTORY_SECRET'] = 'benchmark'
+
+        run(['--db-create', '--db-import', data_path], env)
+        # stores the --list snapshot
+        run(['--list'], env)
+
+        if args.stress:
+            # every import changes all hosts, and with them the generation
+            data = generate_inventory(args.hosts, args.tags, args.groups, args.tags_per_host, args.secrets, args.seed)
+            writer_args = []
+            for port in ['22', '2222']:
+                for host in data['hosts']:
+                    host['ssh_port'] = port
+                path = os.path.join(workdir, 'bench-%s.json' % port)
+                with open(path, 'w') as data_file:
+                    json.dump(data, data_file)
+                writer_args.append(['--db-import', path])
+
+            print "%-8s %-7s %7s %7s %9s %9s %9s" % ('journal', 'role', 'calls', 'failed', 'p50', 'p95', 'max')
+            problems = []
+            for mode in ['delete', 'wal']:
+                mode_env = dict(env, DBINVENTORY_JOURNAL_MODE=mode)
+                calls = stress(mode_env, ['--list'], args.readers, writer_args, args.seconds, args.hosts)
+                for role in ['reader', 'writer']:
+                    timings = [seconds for seconds, error in calls[role]]
+                    errors = [error for seconds, error in calls[role] if error]
+                    if not timings:
+                        problems.append('%s: no %s call finished' % (mode, role))
+                        continue
+                    print "%-8s %-7s %7d %7d %7.0fms %7.0fms %7.0fms" % (mode, role, len(timings), len(errors), percentile(timings, 0.5) * 1000, percentile(timings, 0.95) * 1000, max(timings) * 1000)
+                    if errors:
+                        problems.append('%s: %d failed %s calls, e.g. %s' % (mode, len(errors), role, errors[0]))
+
+                problems += ['%s: %s' % (mode, problem) for problem in check_inventory(mode_env, args)]
+
+            for problem in problems:
+                print problem
+            if problems:
+                sys.exit(1)
+            return
+
+        results = suite(args, workdir, env, db_path, data_path)
+
+        report = OrderedDict([
+            ('inventory', OrderedDict([('hosts', args.hosts), ('tags', args.tags), ('tags_per_host', args.tags_per_host), ('groups', args.groups), ('secrets', args.secrets), ('seed', args.seed)])),
+            ('python', platform.python_version()),
+            ('results', results)])
+
+        if args.json:
+            output = sys.stdout if args.json == '-' else open(args.json, 'w')
+            json.dump(report, output, indent=2)
+            output.write('\n')
+            if output is not sys.stdout:
+                output.close()
+
+        if args.json != '-':
+            print "%-12s %-12s %10s %10s %10s" % ('', '', 'median', 'peak RSS', 'statements')
+            for result in results:
+                print "%-12s %-12s %8.1fms %8.1fMB %10d" % (result['name'], result['mode'], result['wall_ms']['median'], result['peak_rss_kb'] / 1024.0, result['sql_statements'])
+
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--count-sql']:
+        count_sql(sys.argv[2], sys.argv[4:])
+    elif sys.argv[1:2] == ['--ui-refresh']:
+        ui_refresh(sys.argv[2], sys.argv[3])
+    else:
+        main()